@@ -4,20 +4,147 @@ not been sent are not saved.  Note, too, that all of the links reference
 a Salsa Classic account.  If the account goes away, then the emails will
 not have any images."""
 
+import aiohttp
 import argparse
-import datetime
+import asyncio
+import functools
+import orjson
 import os
-import queue
 import re
 import requests
-import threading
+import shelve
 import time
 import yaml
 
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from html import escape, unescape
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urljoin
 
+# The login file is plain data.  Use libyaml's safe loader when it's there.
+try:
+	from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+	from yaml import SafeLoader as _YamlLoader
+
+# The scrubbers from _get_scrubber() rewrite old and dead domains in a URL,
+# join it to the Salsa host, then patch up the joined URL.  One compiled
+# pattern covers each side of the join.  _scrub_html() applies them to the
+# links in a page.
+_DOMAIN_RE = re.compile(r'org2\.democracyinaction\.org|salsa\.democracyinaction\.org|hq\.demaction\.org|cid:')
+_DOMAINS = {
+	'org2.democracyinaction.org': 'org2.salsalabs.com',
+	'salsa.democracyinaction.org': 'org.salsalabs.com',
+	'hq.demaction.org': 'org.salsalabs.com',
+	'cid:': 'https:'
+}
+_JOINED_RE = re.compile(r'^/(?:salsa|o/|dia/|var/)|true|#')
+
+# Characters that aren't allowed in filenames.
+_SAN_RE = re.compile(r'[^A-Za-z0-9\s]')
+
+def _json(r):
+	"""Decode a JSON API response.  orjson reads the raw bytes directly."""
+	return orjson.loads(r.content)
+
+# Directories already created by this process.
+_MKDIR_SEEN = set()
+
+def _ensure_dir(filename):
+	"""Create the directory for filename unless this process already has."""
+	d = os.path.dirname(filename)
+	if d not in _MKDIR_SEEN:
+		os.makedirs(d, exist_ok=True)
+		_MKDIR_SEEN.add(d)
+
+# Month abbreviations in Salsa Classic dates.
+_MONTHS = {
+	'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+	'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+
+def _parse_date(x):
+	"""Worker for OnePage.parse_date().  The month, day and year are all
+	that's needed, so there's no need for strptime.  Only that part of the
+	timestamp is used as the cache key; the time of day would make every
+	key unique."""
+	return _format_date(' '.join(x.strip().split(' ', 4)[:4]))
+
+@functools.lru_cache(maxsize=1024)
+def _format_date(x):
+	"""Format a date like "Mon Oct 09 2017" as "2017-10-09"."""
+	parts = x.split(' ')
+	return f"{int(parts[3]):04d}-{_MONTHS[parts[1]]:02d}-{int(parts[2]):02d}"
+
+@functools.lru_cache(maxsize=None)
+def _get_scrubber(host):
+	"""Return a function that scrubs a URL for the provided Salsa host."""
+	base = f"https://{host}"
+
+	def joined(m):
+		x = m.group(0)
+		if x == '#':
+			return '%23'
+		if x == 'true':
+			return f"{base}/true/"
+		return f"{base}{x}"
+
+	def scrub(v):
+		v = _DOMAIN_RE.sub(lambda m: _DOMAINS[m.group(0)], v)
+		v = urljoin(base, v)
+		return _JOINED_RE.sub(joined, v)
+
+	return scrub
+
+# Raw HTML is scrubbed without building a DOM.  _TAG_RE finds the tags that
+# carry links.  Comments and the code inside <script> elements are matched so
+# that they can be passed through untouched.  As in HTML, a quote only starts
+# a quoted value right after an "=", so "title=Don't" doesn't hide the rest
+# of the tag.  _ATTR_RE walks a tag's attributes one at a time, so text
+# inside a value is never mistaken for another attribute.
+_TAG_BODY = rb'''(?:[^>=]|=\s*(?:"[^"]*"|'[^']*'|[^\s>]*))*>'''
+_TAG_RE = re.compile(
+	rb'<!--.*?(?:-->|\Z)'
+	rb'|(?P<script><script\b' + _TAG_BODY + rb')(?P<code>.*?(?:</script\s*>|\Z))'
+	rb'|(?P<tag><(?:a|link|img)\b' + _TAG_BODY + rb')',
+	re.IGNORECASE | re.DOTALL)
+_ATTR_RE = re.compile(rb'''(\s([^\s=>"'/]+)\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+
+def _scrub_html(body, host):
+	"""Scrub the href and src attributes of the <a>, <link>, <img> and <script>
+	tags in a buffer of raw HTML.  Everything else is left alone.  Returns the
+	scrubbed HTML as bytes."""
+	scrub = _get_scrubber(host)
+
+	def attr(m):
+		if m.group(2).lower() not in (b'href', b'src'):
+			return m.group(0)
+		raw = next(g for g in m.group(3, 4, 5) if g is not None)
+		v = unescape(raw.decode('utf-8', 'surrogateescape'))
+		x = scrub(v)
+		if x == v:
+			return m.group(0)
+		x = escape(x).encode('utf-8', 'surrogateescape')
+		return m.group(1) + b'"' + x + b'"'
+
+	def tag(m):
+		if m.group('tag') is not None:
+			return _ATTR_RE.sub(attr, m.group('tag'))
+		if m.group('script') is not None:
+			return _ATTR_RE.sub(attr, m.group('script')) + m.group('code')
+		return m.group(0)
+
+	return _TAG_RE.sub(tag, body)
+
+def _scrub_and_write(body, html, host):
+	"""Process pool task.  Scrub a blast's raw HTML and write it to the file
+	named by html."""
+	_ensure_dir(html)
+	with open(html, 'wb', buffering=1 << 20) as f:
+		f.write(_scrub_html(body, host))
+
 class Spec:
 	"""Accessory class to define a public-facing page type in Salsa.  The
 	data elements are passed in the keyword argument list."""
@@ -30,42 +157,42 @@ class Spec:
 		titleField:   field name to use for the title
 		keyField:     primary key name
 		dateField:    the creation date, or None
+
+		The API "include" list and whether there's a date are derived
+		once here rather than for every record.
 		"""
 		self.__dict__.update(kwargs)
+		fields = [self.keyField, self.titleField, self.dateField]
+		self.include = ",".join(f for f in fields if f is not None)
+		self.hasDate = self.dateField is not None
 
 	def __repr__(self):
 		"""String/dump representation of this class. """
 		return f"Spec({self.url!r}, {self.table!r}, {self.titleField!r}, {self.keyField!r}, {self.dateField!r})"
 
-class OnePage(threading.Thread):
+class OnePage:
 	"""Class to process a single page."""
 
-	def __init__(self, taskName, taskQueue, queueLock):
+	def __init__(self, **kwargs):
 		""" Initialize an instance of OnePage.  The keyword arguments are
 		spec:         instance of Spec. Defines the database parts.
 		salsa:        instance of Salsa.  Defines how to get to Salsa.
 		key:          primary key for the page
+		record:       the blast's record from Salsa.iterRecords()
 		html:	      directory to use for storing htmls
+		cache:        instance of ScrapeCache.  Remembers finished blasts.
 		"""
-		threading.Thread.__init__(self)
-		self.taskName = taskName
-		self.taskQueue = taskQueue
-		self.queueLock = queueLock
-		self.exitFlag = 0
+		self.__dict__.update(kwargs)
+		args = {
+			'host': self.salsa.host,
+			'organization_KEY': self.salsa.orgKey,
+			'key': self.key
+		}
+		self.url = self.spec.url.format(**args)
 
 	def __repr__(self):
 		"""String/dump representation of this class. """
-		return f"OnePage:{self.taskName}({self.spec}, {self.salsa}, {self.key}, {self.url})"
-
-	def assureDir(self, filename):
-		""" Make sure that the directory exists for the provided filename. """
-
-		d = Path(filename).parent
-		if not d.exists():
-			try:
-				os.makedirs(str(d))
-			except FileExistsError:
-				pass
+		return f"OnePage({self.spec}, {self.salsa}, {self.key}, {self.url})"
 
 	def getHtmlFilename(self, dir, record, ext):
 		"""Fabricate a filename using the page spec and a record
@@ -74,86 +201,85 @@ class OnePage(threading.Thread):
 
 		date = ""
 		k = self.key
-		if self.spec.dateField != None:
+		if self.spec.hasDate:
 			if len(record[self.spec.dateField]) > 0:
 				date = self.parse_date(record[self.spec.dateField])
 				k = f" {self.key}"
-		pattern = re.compile("[^A-Za-z0-9\\s]")
-		x = pattern.sub('', record[self.spec.titleField], 0).strip()
+		x = _SAN_RE.sub('', record[self.spec.titleField]).strip()
 		x = Path(self.html).joinpath(self.spec.table, f"{date}{k} {x}.{ext}")
 		return str(x)
 
 	def parse_date(self, x):
-		"""Parse Salsa Classic date into a datetime.
+		"""Parse Salsa Classic date into a YYYY-MM-DD string.
 		Input is like "Mon Oct 09 2017 19:25:56 GMT-0400"
-		Output is a datetime object."""
-
-		x = x.split(" GMT")[0].strip()
-		f = '%a %b %d %Y %X'
-		t = datetime.datetime.strptime(x, f)
-		return'{0:%Y-%m-%d}'.format(t)
-
-	def run(self):
-		"""Process a queue of email_blast_KEYs. Create and print HTML for each key."""
-		while not self.exitFlag:
-			self.queueLock.acquire()
-			if self.taskQueue.empty():
-				self.queueLock.release()
-				time.sleep(1)
-			else:
-				task = self.taskQueue.get()
-				self.queueLock.release()
-				self.handleTask(task)
-	
-	def handleTask(self, task):
-		"""Process a task."""
-		self.__dict__.update(task)
-
-		record = self.salsa.getRecord(self.spec, self.key)
-		args = {
-			'host': self.salsa.host,
-			'organization_KEY': self.salsa.orgKey,
-			'key': self.key
-		}
-		self.url = self.spec.url.format(**args)
+		Output is like "2017-10-09"."""
+
+		return _parse_date(x)
+
+	async def run(self, session, pool):
+		"""Fetch the blast using session, an aiohttp.ClientSession.  Scrubbing
+		and writing the HTML happen in pool, a ProcessPoolExecutor.  Fetch
+		failures are retried a couple of times, then reported and skipped."""
+
+		# Blasts written by an earlier run are skipped before anything is fetched.
+		cacheKey = f"{self.spec.table}:{self.key}"
+		if self.cache.done(cacheKey):
+			print(f"{self.key} skipped")
+			return
+
+		html = self.getHtmlFilename(self.html, self.record, 'html')
+		if os.path.isfile(html):
+			self.cache.remember(cacheKey, html)
+			print(f"{html} skipped")
+			return
+
+		# Timeouts, dropped connections and gateway errors get a couple more
+		# tries.  A blast that still fails is reported and skipped so that it
+		# can't stop the rest of the run.
+		body = None
+		for attempt in range(3):
+			try:
+				async with session.get(self.url) as resp:
+					if resp.status not in (502, 503, 504):
+						body = await resp.read()
+						break
+					error = f"HTTP {resp.status}"
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				error = repr(e)
+			if attempt < 2:
+				await asyncio.sleep(0.3 * 2 ** attempt)
+		if body is None:
+			print(f"{self.url} gave up: {error}")
+			return
+
+		loop = asyncio.get_running_loop()
+		await loop.run_in_executor(pool, _scrub_and_write, body, html, self.salsa.host)
+		self.cache.remember(cacheKey, html)
+		print(html)
+
+class ScrapeCache:
+	"""Persistent record of the blasts that earlier runs have already written.
+	Cache keys look like "table:key".  Values hold the path and the time that
+	it was written."""
+
+	def __init__(self, dir):
+		"""Open (or create) the cache in the provided directory."""
+		os.makedirs(dir, exist_ok=True)
+		self.shelf = shelve.open(os.path.join(dir, '.scrape_cache'))
+
+	def done(self, cacheKey):
+		"""Returns True if the blast was written and the file is still there."""
+		entry = self.shelf.get(cacheKey)
+		return entry is not None and os.path.isfile(entry['path'])
+
+	def remember(self, cacheKey, path):
+		"""Record that the blast for cacheKey was written to path."""
+		self.shelf[cacheKey] = { 'path': path, 'ts': int(time.time()) }
+
+	def close(self):
+		"""Flush and close the cache."""
+		self.shelf.close()
 
-		resp = requests.get(self.url)
-		soup = BeautifulSoup(resp.text, 'html.parser')
-		links = soup.select('a,link,img,script')
-		for link in links:
-			for k in ['href', 'src']:
-				if k in link.attrs:
-					v = link[k]
-					x = self.scrub(v)
-					if x != v:
-						link.attrs[k] = x
-
-		html = self.getHtmlFilename(self.html, record, 'html')
-		self.assureDir(html)
-		with open(html, 'w') as f:
-			f.write(str(soup))
-			print(f"{self.taskName} {html}")
-			f.close()
-
-	def scrub(self, v):
-		""" Replace old and dead domains with current domains and return the result."""
-		host = f"https://{self.salsa.host}"
-		v = v.replace('org2.democracyinaction.org', 'org2.salsalabs.com')
-		v = v.replace('salsa.democracyinaction.org','org.salsalabs.com')
-		v = v.replace('hq.demaction.org','org.salsalabs.com')
-		v = v.replace('cid:', 'https:')
-		v = urljoin(host, v)
-		v = re.sub('^/salsa', f"https://{self.salsa.host}/salsa", v)
-		v = re.sub('^/o/', f"https://{self.salsa.host}/o/", v)
-		v = re.sub('^/dia/', f"https://{self.salsa.host}/dia/", v)
-		v = re.sub('^/var/', f"https://{self.salsa.host}/var/", v)
-		v = re.sub('true', f"https://{self.salsa.host}/true/", v)
-		v = v.replace('#', '%23')
-		return v
-
-	def setExitFlag(self):
-		"""Sets the exit flag.  This task will exit at the next pass."""
-		self.exitFlag = 1
 class Salsa:
 	""" Class to do Salsa API things. """
 
@@ -168,9 +294,17 @@ class Salsa:
 			'password': cred['password'],
 			'json': True }
 		self.session = requests.Session()
+
+		# Pool the connections for API calls and retry the occasional
+		# gateway error.  Blasts themselves are fetched with aiohttp.
+		retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retry)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+
 		u = f"https://{self.host}/api/authenticate.sjs"
 		r = self.session.get(u, params=payload)
-		j = r.json()
+		j = _json(r)
 		if j['status'] == 'error':
 			print('Authentication failed: ', j)
 			exit(1)
@@ -181,27 +315,28 @@ class Salsa:
 		"""String/dump representation of this class. """
 		return f"Salsa({self.host!r}, {self.email!r}, {self.orgKey}, {self.orgName})"
 
-	def readKeys(self, spec):
-		"""Use the provided spec to read all of the primary keys
-		for a table. Returns a list of primary keys."""
+	def iterRecords(self, spec):
+		"""Use the provided spec to read the records for completed blasts.
+		Each record has the primary key, the "title" field and the date,
+		typically Date_Created.  Yields records as each batch arrives."""
 
 		offset = 0
 		count = 500
 		u = f"https://{self.host}/api/getObjects.sjs"
-		keys = []
 		while count == 500:
 			payload = {
 				'json': True,
 				'limit': f"{offset},{count}",
 				'object': spec.table,
-				'include': f"{spec.keyField},{spec.titleField},{spec.dateField},Stage"
+				'include': f"{spec.include},Stage"
 			}
 			r = self.session.get(u, params=payload)
-			j = r.json()
-			[ keys.append(r[spec.keyField]) for r in j if r['Stage'] == 'Complete']
+			j = _json(r)
+			for r in j:
+				if r['Stage'] == 'Complete':
+					yield r
 			count = len(j)
 			offset = offset + count
-		return keys
 
 	def getOrganizationInfo(self):
 		"""Read the organization table to retrieve the key and name."""
@@ -214,7 +349,7 @@ class Salsa:
 			'include': 'organization_KEY,name'
 		}
 		r = self.session.get(u, params=payload)
-		j = r.json()
+		j = _json(r)
 		if len(j) >= 0:
 			# Need this to skip organization_KEY 0...
 			for org in j:
@@ -225,27 +360,6 @@ class Salsa:
 		print("getOrganizationInfo: no matching organizations found")
 		exit(1)
 
-	def getRecord(self, spec, key):
-		"""Use the API to retrieve a record using spec.  Returns the primary key,
-		the "title" field and the date, typically Date_Created. Errors are noisily
-		fatal."""
-
-		u = f"https://{self.host}/api/getObject.sjs"
-		includes = [
-			spec.keyField,
-			spec.titleField,
-			spec.dateField ]
-
-		payload = {
-			'json': True,
-			'key': key,
-			'object': spec.table,
-			'include': ",".join(includes)
-		}
-		r = self.session.get(u, params=payload)
-		j = r.json()
-		return j
-
 class Main:
 	"""Mainline application.  Does the work.  Dies a noisy death on errors."""
 
@@ -263,8 +377,10 @@ class Main:
 		if self.args.loginFile == None:
 			print("Error: --login is REQUIRED.")
 			exit(1)
-		cred = yaml.load(open(self.args.loginFile))
+		with open(self.args.loginFile) as f:
+			cred = yaml.load(f, Loader=_YamlLoader)
 		self.salsa = Salsa(cred)
+		self.cache = ScrapeCache(self.args.html)
 		self.spec = Spec(**{
 			'url': "https://{host}/o/{organization_KEY}/t/0/blastContent.jsp?email_blast_KEY={key}",
 		 	'table': "email_blast",
@@ -273,36 +389,67 @@ class Main:
 		 	'dateField': "Date_Created"
 		 })
 
-		threadCount = 10
-		taskQueue = queue.Queue()
-		queueLock = threading.Lock()
-
-		queueLock.acquire()
-		self.fill(taskQueue)
-		queueLock.release()		
-
-		threads = [OnePage(f"Task-{(i+1):02}", taskQueue, queueLock) for i in range(0, threadCount)]
-		[t.start() for t in threads]
-		while not taskQueue.empty():
-			pass
-
-		[t.setExitFlag() for t in threads]
-		[t.join() for t in threads]
+		try:
+			asyncio.run(self.fetchAll())
+		finally:
+			self.cache.close()
 		print("Done!")
 
-	def fill(self, taskQueue):
-		""" Read all blast keys and fill the queue with tasks for each key. """
-
-		keys = self.salsa.readKeys(self.spec)
-		print(f"Found {len(keys)} completed email blasts.")
-		for key in keys:
-			task = {
-				'spec': self.spec,
-				'salsa': self.salsa,
-				'html': self.args.html,
-				'key': key
-			}
-			taskQueue.put(task)
+	async def fetchAll(self):
+		""" Read all blast records and fetch each blast.  Fetches start as
+		soon as the first batch of records arrives. """
+
+		loop = asyncio.get_running_loop()
+		records = self.salsa.iterRecords(self.spec)
+		connector = aiohttp.TCPConnector(limit=50, limit_per_host=20)
+		timeout = aiohttp.ClientTimeout(sock_connect=5, sock_read=30)
+		cookies = self.salsa.session.cookies.get_dict()
+		# Fetched bodies wait in memory for the process pool, so only
+		# fetchCount blasts are in flight at a time.
+		fetchCount = 50
+		limit = asyncio.Semaphore(fetchCount)
+		pending = set()
+		failures = []
+		count = 0
+		exhausted = False
+
+		def finished(task):
+			pending.discard(task)
+			limit.release()
+			if not task.cancelled() and task.exception() is not None:
+				failures.append(task.exception())
+
+		with ProcessPoolExecutor() as pool:
+			async with aiohttp.ClientSession(connector=connector, timeout=timeout, cookies=cookies) as session:
+				# Reading records is a blocking API call.  Step through them
+				# in a thread so that the event loop keeps running.
+				while not failures:
+					record = await loop.run_in_executor(None, next, records, None)
+					if record is None:
+						exhausted = True
+						print(f"Found {count} completed email blasts.")
+						break
+					page = OnePage(**{
+						'spec': self.spec,
+						'salsa': self.salsa,
+						'html': self.args.html,
+						'cache': self.cache,
+						'key': record[self.spec.keyField],
+						'record': record
+					})
+					await limit.acquire()
+					task = asyncio.ensure_future(page.run(session, pool))
+					task.add_done_callback(finished)
+					pending.add(task)
+					count = count + 1
+				if not exhausted:
+					print(f"Stopped early after {count} email blasts.")
+				await asyncio.gather(*pending, return_exceptions=True)
+
+		# Anything other than a failed fetch is an internal error.  Those
+		# are noisily fatal.
+		if failures:
+			raise failures[0]
 
 def main():
 	Main()
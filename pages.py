@@ -3,18 +3,27 @@ them to disk as PDFs.  Note that this app cannot handle targeted or multi-conten
 targeted actions."""
 
 import argparse
-import datetime
+import functools
+import hashlib
 import json
+import multiprocessing
+import orjson
 import os
 import pdfkit
 import re
 import sys
 import requests
+import shelve
+import shutil
+import time
 import urllib.parse
 import yaml
 
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from html import escape, unescape
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # The PDF app, wkhtml2pdf, uses these options to format from HTML,
 # Global to make it easy to make changes.  Used in OnePage.run().
@@ -31,6 +40,125 @@ wkhtml2pdfOptions = {
     'zoom': '1.2'
 }
 
+# The login file is plain data.  Use libyaml's safe loader when it's there.
+try:
+	from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+	from yaml import SafeLoader as _YamlLoader
+
+# The scrubbers from _get_scrubber() rewrite old and dead domains in a URL,
+# join it to the Salsa host, then patch up the joined URL.  One compiled
+# pattern covers each side of the join.  _scrub_html() applies them to the
+# links in a page.
+_DOMAIN_RE = re.compile(r'org2\.democracyinaction\.org|salsa\.democracyinaction\.org|hq\.demaction\.org|cid:')
+_DOMAINS = {
+	'org2.democracyinaction.org': 'org2.salsalabs.com',
+	'salsa.democracyinaction.org': 'org.salsalabs.com',
+	'hq.demaction.org': 'org.salsalabs.com',
+	'cid:': 'https:'
+}
+_JOINED_RE = re.compile(r'^/(?:salsa|o/|dia/|var/)|true|#')
+
+# Characters that aren't allowed in filenames.
+_SAN_RE = re.compile(r'[^A-Za-z0-9\s]')
+
+def _json(r):
+	"""Decode a JSON API response.  orjson reads the raw bytes directly."""
+	return orjson.loads(r.content)
+
+# Directories already created by this process.
+_MKDIR_SEEN = set()
+
+def _ensure_dir(filename):
+	"""Create the directory for filename unless this process already has."""
+	d = os.path.dirname(filename)
+	if d not in _MKDIR_SEEN:
+		os.makedirs(d, exist_ok=True)
+		_MKDIR_SEEN.add(d)
+
+def _pdf_written(pdf):
+	"""Returns True if wkhtml2pdf left a non-empty PDF at pdf."""
+	return os.path.isfile(pdf) and os.path.getsize(pdf) > 0
+
+# Month abbreviations in Salsa Classic dates.
+_MONTHS = {
+	'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+	'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+
+def _parse_date(x):
+	"""Worker for OnePage.parse_date().  The month, day and year are all
+	that's needed, so there's no need for strptime.  Only that part of the
+	timestamp is used as the cache key; the time of day would make every
+	key unique."""
+	return _format_date(' '.join(x.strip().split(' ', 4)[:4]))
+
+@functools.lru_cache(maxsize=1024)
+def _format_date(x):
+	"""Format a date like "Mon Oct 09 2017" as "2017-10-09"."""
+	parts = x.split(' ')
+	return f"{int(parts[3]):04d}-{_MONTHS[parts[1]]:02d}-{int(parts[2]):02d}"
+
+@functools.lru_cache(maxsize=None)
+def _get_scrubber(host):
+	"""Return a function that scrubs a URL for the provided Salsa host."""
+	base = f"https://{host}"
+
+	def joined(m):
+		x = m.group(0)
+		if x == '#':
+			return '%23'
+		if x == 'true':
+			return f"{base}/true/"
+		return f"{base}{x}"
+
+	def scrub(v):
+		v = _DOMAIN_RE.sub(lambda m: _DOMAINS[m.group(0)], v)
+		v = urllib.parse.urljoin(base, v)
+		return _JOINED_RE.sub(joined, v)
+
+	return scrub
+
+# Raw HTML is scrubbed without building a DOM.  _TAG_RE finds the tags that
+# carry links.  Comments and the code inside <script> elements are matched so
+# that they can be passed through untouched.  As in HTML, a quote only starts
+# a quoted value right after an "=", so "title=Don't" doesn't hide the rest
+# of the tag.  _ATTR_RE walks a tag's attributes one at a time, so text
+# inside a value is never mistaken for another attribute.
+_TAG_BODY = rb'''(?:[^>=]|=\s*(?:"[^"]*"|'[^']*'|[^\s>]*))*>'''
+_TAG_RE = re.compile(
+	rb'<!--.*?(?:-->|\Z)'
+	rb'|(?P<script><script\b' + _TAG_BODY + rb')(?P<code>.*?(?:</script\s*>|\Z))'
+	rb'|(?P<tag><(?:a|link|img)\b' + _TAG_BODY + rb')',
+	re.IGNORECASE | re.DOTALL)
+_ATTR_RE = re.compile(rb'''(\s([^\s=>"'/]+)\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+
+def _scrub_html(body, host):
+	"""Scrub the href and src attributes of the <a>, <link>, <img> and <script>
+	tags in a buffer of raw HTML.  Everything else is left alone.  Returns the
+	scrubbed HTML as bytes."""
+	scrub = _get_scrubber(host)
+
+	def attr(m):
+		if m.group(2).lower() not in (b'href', b'src'):
+			return m.group(0)
+		raw = next(g for g in m.group(3, 4, 5) if g is not None)
+		v = unescape(raw.decode('utf-8', 'surrogateescape'))
+		x = scrub(v)
+		if x == v:
+			return m.group(0)
+		x = escape(x).encode('utf-8', 'surrogateescape')
+		return m.group(1) + b'"' + x + b'"'
+
+	def tag(m):
+		if m.group('tag') is not None:
+			return _ATTR_RE.sub(attr, m.group('tag'))
+		if m.group('script') is not None:
+			return _ATTR_RE.sub(attr, m.group('script')) + m.group('code')
+		return m.group(0)
+
+	return _TAG_RE.sub(tag, body)
+
 class Spec:
 	"""Accessory class to define a public-facing page type in Salsa.  The
 	data elements are passed in the keyword argument list."""
@@ -43,8 +171,14 @@ class Spec:
 		titleField:   field name to use for the title
 		keyField:     primary key name
 		dateField:    the creation date, or None
+
+		The API "include" list and whether there's a date are derived
+		once here rather than for every record.
 		"""
 		self.__dict__.update(kwargs)
+		fields = [self.keyField, self.titleField, self.dateField]
+		self.include = ",".join(f for f in fields if f is not None)
+		self.hasDate = self.dateField is not None
 
 	def __repr__(self):
 		"""String/dump representation of this class. """
@@ -58,8 +192,12 @@ class OnePage:
 		spec:         instance of Spec
 		salsa:        instance of Salsa
 		key:          primary key for the page
+		record:       the page's record from Salsa.readRecords()
 		pdfs:         directory to use for storing pdfs
 		html:	      directory to use for storing htmls
+		htmlOnly:     True to skip writing PDFs
+		rendered:     dict of scrubbed body digests to PDF filenames, shared
+		              by all of the processes
 		"""
 
 		self.__dict__.update(kwargs)
@@ -77,12 +215,7 @@ class OnePage:
 	def assureDir(self, filename):
 		""" Make sure that the directory exists for the provided filename. """
 
-		d = Path(filename).parent
-		if not d.exists():
-			try:
-				os.makedirs(str(d))
-			except FileExistsError:
-				pass
+		_ensure_dir(filename)
 
 	def getHtmlFilename(self, record):
 		"""Fabricate a filename using the page spec and a record
@@ -103,88 +236,95 @@ class OnePage:
 
 		date = ""
 		k = self.key
-		if self.spec.dateField != None:
+		if self.spec.hasDate:
 			if len(record[self.spec.dateField]) > 0:
 				date = self.parse_date(record[self.spec.dateField])
 				k = f" {self.key}"
-		pattern = re.compile("[^A-Za-z0-9\\s]")
-		x = pattern.sub('', record[self.spec.titleField], 0).strip()
+		x = _SAN_RE.sub('', record[self.spec.titleField]).strip()
 		x = Path(dir).joinpath(self.spec.table, f"{date}{k} {x}.{ext}")
 		return str(x)
 
 	def parse_date(self, x):
-		"""Parse Salsa Classic date into a datetime.
+		"""Parse Salsa Classic date into a YYYY-MM-DD string.
 		Input is like "Mon Oct 09 2017 19:25:56 GMT-0400"
-		Output is a datetime object."""
+		Output is like "2017-10-09"."""
 
-		x = x.split(" GMT")[0].strip()
-		f = '%a %b %d %Y %X'
-		t = datetime.datetime.strptime(x, f)
-		return'{0:%Y-%m-%d}'.format(t)
+		return _parse_date(x)
 
 	def run(self):
-		"""Execute `wkhtml2pdf` using a buffer and a filename.  The buffer contains
-		the page contents with modifications to correct old and dead Salsa domains.
-		wkhtml2pdf errors are ignored.  Internal errors are noisily fatal."""
-
-		record = self.salsa.getRecord(self.spec, self.key)
+		"""Execute `wkhtml2pdf` using an HTML file and a PDF filename.  The HTML file
+		contains the page contents with modifications to correct old and dead Salsa domains.
+		wkhtml2pdf failures are retried a couple of times, then reported and
+		skipped, as are pages that can't be fetched.  Internal errors are
+		noisily fatal.
+		Returns the name of the file that was written, or None if there isn't one."""
+
+		record = self.record
+		html = self.getHtmlFilename(record)
+		pdf = self.getPdfFilename(record)
+		if not self.htmlOnly and _pdf_written(pdf):
+			print(f"{self.url} skipped")
+			return pdf
 		print(self.url)
 
-		resp = requests.get(self.url)
-		soup = BeautifulSoup(resp.text, 'html.parser')
-		links = soup.select('a,link,img,script')
-		for link in links:
-			for k in ['href', 'src']:
-				if k in link.attrs:
-					v = link[k]
-					x = self.scrub(v)
-					if x != v:
-						link.attrs[k] = x
+		# A page that times out or drops its connection is reported and
+		# skipped so that it can't stop the rest of the pool.
+		buf = bytearray()
+		try:
+			with self.salsa.session.get(self.url, timeout=(5, 30), stream=True) as resp:
+				for chunk in resp.iter_content(chunk_size=64 * 1024):
+					buf.extend(chunk)
+		except requests.RequestException as e:
+			print(f"{self.url} fetch failed: {e}")
+			return None
+		body = _scrub_html(buf, self.salsa.host)
 
-		html = self.getHtmlFilename(record)
 		self.assureDir(html)
-		with open(html, 'w') as f:
-			f.write(str(soup))
-			f.close()
+		with open(html, 'wb', buffering=1 << 20) as f:
+			f.write(body)
 		if self.htmlOnly:
-			return
+			return html
 
-		pdf = self.getPdfFilename(record)
-		if os.path.isfile(pdf):
-			print(f"{self.url} skipped")
-			return
 		self.assureDir(pdf)
 
-		try:
-			pdfkit.from_string(str(soup), pdf, wkhtml2pdfOptions)
-		except:
-			# print("Unexpected error:", sys.exc_info()[0])
-			# raise
-			pass
-		return
-
-	def scrub(self, v):
-		""" Replace old and dead domains with current domains and return the result."""
-		host = f"https://{self.salsa.host}"
-		v = v.replace('org2.democracyinaction.org', 'org2.salsalabs.com')
-		v = v.replace('salsa.democracyinaction.org','org.salsalabs.com')
-		v = v.replace('hq.demaction.org','org.salsalabs.com')
-		v = v.replace('cid:', 'https:')
-		v = urllib.parse.urljoin(host, v)
-		v = re.sub('^/salsa', f"https://{self.salsa.host}/salsa", v)
-		v = re.sub('^/o/', f"https://{self.salsa.host}/o/", v)
-		v = re.sub('^/dia/', f"https://{self.salsa.host}/dia/", v)
-		v = re.sub('^/var/', f"https://{self.salsa.host}/var/", v)
-		v = re.sub('true', f"https://{self.salsa.host}/true/", v)
-		v = v.replace('#', '%23')
-		return v
+		# Blasts often reuse a template.  Copy the PDF of an identical page
+		# rather than rendering it again.
+		digest = hashlib.blake2b(body, digest_size=16).digest()
+		prev = self.rendered.get(digest)
+		if prev is not None and os.path.isfile(prev):
+			shutil.copyfile(prev, pdf)
+			print(f"{self.url} copied from {prev}")
+			return pdf
+
+		# wkhtml2pdf reads the HTML file that was just written.  That lets it
+		# honor the page's own charset.
+		for attempt in range(3):
+			try:
+				pdfkit.from_file(html, pdf, wkhtml2pdfOptions)
+				break
+			except OSError:
+				# wkhtml2pdf reports missing images and scripts as errors even
+				# when it writes the PDF.  Retry only if there's no PDF.
+				if _pdf_written(pdf):
+					break
+				if attempt < 2:
+					time.sleep(0.5 * 2 ** attempt)
+		if _pdf_written(pdf):
+			self.rendered[digest] = pdf
+			return pdf
+		# Don't leave an empty or partial PDF around to be cached or copied.
+		print(f"{self.url} gave up on {pdf}")
+		if os.path.isfile(pdf):
+			os.remove(pdf)
+		return None
 
 class Salsa:
 	""" Class to do Salsa API things. """
 
-	def __init__(self, cred):
+	def __init__(self, cred, announce=True):
 		""" Authenticate with Salsa.  Die a noisy death if that fails.
-		Store a requests.Session object with the required cookie(s) in it."""
+		Store a requests.Session object with the required cookie(s) in it.
+		Set announce to False to skip the organization banner."""
 
 		self.host = cred['host']
 		self.email = cred['email']
@@ -193,40 +333,50 @@ class Salsa:
 			'password': cred['password'],
 			'json': True }
 		self.session = requests.Session()
+
+		# Every page comes from the same host.  Pool the connections and
+		# retry the occasional gateway error.
+		retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retry)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+
 		u = f"https://{self.host}/api/authenticate.sjs"
 		r = self.session.get(u, params=payload)
-		j = r.json()
+		j = _json(r)
 		if j['status'] == 'error':
 			print('Authentication failed: ', j)
 			exit(1)
 		self.getOrganizationInfo()
-		print(f"Salsa: creating PDFs for {self.orgName}")
+		if announce:
+			print(f"Salsa: creating PDFs for {self.orgName}")
 
 	def __repr__(self):
 		"""String/dump representation of this class. """
 		return f"Salsa({self.host!r}, {self.email!r}, {self.orgKey}, {self.orgName})"
 
-	def readKeys(self, spec):
-		"""Use the provided spec to read all of the primary keys
-		for a table. Returns a list of primary keys."""
+	def readRecords(self, spec):
+		"""Use the provided spec to read all of the records for a table.
+		Returns a list of records with the primary key, the "title" field
+		and the date, typically Date_Created."""
 
 		offset = 0
 		count = 500
 		u = f"https://{self.host}/api/getObjects.sjs"
-		keys = []
+		records = []
 		while count == 500:
 			payload = {
 				'json': True,
 				'limit': f"{offset},{count}",
 				'object': spec.table,
-				'include': f"{spec.keyField},{spec.titleField},{spec.dateField}"
+				'include': spec.include
 			}
 			r = self.session.get(u, params=payload)
-			j = r.json()
-			[ keys.append(r[spec.keyField]) for r in j ]
+			j = _json(r)
+			records.extend(j)
 			count = len(j)
 			offset = offset + count
-		return keys
+		return records
 
 	def getOrganizationInfo(self):
 		"""Read the organization table to retrieve the key and name."""
@@ -239,7 +389,7 @@ class Salsa:
 			'include': 'organization_KEY,name'
 		}
 		r = self.session.get(u, params=payload)
-		j = r.json()
+		j = _json(r)
 		if len(j) >= 0:
 			# Need this to skip organization_KEY 0...
 			for org in j:
@@ -250,26 +400,45 @@ class Salsa:
 		print("getOrganizationInfo: no matching organizations found")
 		exit(1)
 
-	def getRecord(self, spec, key):
-		"""Use the API to retrieve a record using spec.  Returns the primary key,
-		the "title" field and the date, typically Date_Created. Errors are noisily
-		fatal."""
-
-		u = f"https://{self.host}/api/getObject.sjs"
-		includes = [
-			spec.keyField,
-			spec.titleField,
-			spec.dateField ]
-
-		payload = {
-			'json': True,
-			'key': key,
-			'object': spec.table,
-			'include': ",".join(includes)
-		}
-		r = self.session.get(u, params=payload)
-		j = r.json()
-		return j
+# Each process in Main.run()'s pool authenticates once and keeps its own
+# Salsa instance here.  A live requests.Session doesn't pickle well.
+# _RENDERED is the pool's shared proxy for OnePage.rendered.
+_SALSA = None
+_RENDERED = None
+
+def _worker_init(cred, rendered):
+	"""Process pool initializer.  Authenticate with Salsa once per worker."""
+	global _SALSA, _RENDERED
+	_SALSA = Salsa(cred, announce=False)
+	_RENDERED = rendered
+
+def _render_one(kwargs):
+	"""Process pool task.  Run a OnePage using this worker's Salsa.  Returns
+	the name of the file that was written."""
+	return OnePage(salsa=_SALSA, rendered=_RENDERED, **kwargs).run()
+
+class ScrapeCache:
+	"""Persistent record of the pages that earlier runs have already written.
+	Cache keys look like "table:key:ext".  Values hold the path and the time
+	that it was written."""
+
+	def __init__(self, dir):
+		"""Open (or create) the cache in the provided directory."""
+		os.makedirs(dir, exist_ok=True)
+		self.shelf = shelve.open(os.path.join(dir, '.scrape_cache'))
+
+	def done(self, cacheKey):
+		"""Returns True if the page was written and the file is still there."""
+		entry = self.shelf.get(cacheKey)
+		return entry is not None and os.path.isfile(entry['path'])
+
+	def remember(self, cacheKey, path):
+		"""Record that the page for cacheKey was written to path."""
+		self.shelf[cacheKey] = { 'path': path, 'ts': int(time.time()) }
+
+	def close(self):
+		"""Flush and close the cache."""
+		self.shelf.close()
 
 class Main:
 	"""Mainline application.  Does the work.  Dies a noisy death on errors."""
@@ -297,8 +466,10 @@ class Main:
 		if self.args.loginFile == None:
 			print("Error: --login is REQUIRED.")
 			exit(1)
-		self.cred = yaml.load(open(self.args.loginFile))
+		with open(self.args.loginFile) as f:
+			self.cred = yaml.load(f, Loader=_YamlLoader)
 		self.salsa = Salsa(self.cred)
+		self.cache = ScrapeCache(self.args.html)
 
 	def run(self):
 		"""Main authenticates with Salsa and then calls the methods to
@@ -306,19 +477,31 @@ class Main:
 
 		# Filter down to the tables int the credentials file.
 		self.specList = [ spec for spec in self.specList if spec.table in self.cred['pages']]
-		for spec in self.specList:
-			keys = self.salsa.readKeys(spec)
-			for key in keys:
-				kwargs = {
-					'spec': spec,
-					'salsa': self.salsa,
-					'pdfs': self.args.pdfs,
-					'html': self.args.html,
-					'htmlOnly': self.args.htmlOnly,
-					'key': key
-				}
-				task = OnePage(**kwargs)
-				task.run()
+
+		# Pages render in a pool of processes so that several wkhtml2pdf
+		# instances can run at the same time.
+		ext = 'html' if self.args.htmlOnly else 'pdf'
+		try:
+			with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_worker_init, initargs=(self.cred, manager.dict())) as ex:
+				for spec in self.specList:
+					# Pages written by an earlier run are skipped before
+					# anything is fetched.
+					records = self.salsa.readRecords(spec)
+					records = [r for r in records if not self.cache.done(f"{spec.table}:{r[spec.keyField]}:{ext}")]
+					tasks = [{
+						'spec': spec,
+						'pdfs': self.args.pdfs,
+						'html': self.args.html,
+						'htmlOnly': self.args.htmlOnly,
+						'key': r[spec.keyField],
+						'record': r
+					} for r in records]
+					for r, path in zip(records, ex.map(_render_one, tasks)):
+						if path is not None:
+							self.cache.remember(f"{spec.table}:{r[spec.keyField]}:{ext}", path)
+		finally:
+			self.cache.close()
+
 def main():
 	pageSpecs = [
 		# API call returns "invalid object/query" for these:
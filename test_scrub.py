@@ -0,0 +1,58 @@
+"""Tests for the raw HTML scrubber in pages.py and just_blast_html.py.
+Run them with `nosetests`."""
+
+import just_blast_html
+import pages
+
+HOST = 'salsa4.salsalabs.com'
+
+def check(html, expected):
+	"""Both apps should scrub html into expected."""
+	for app in [pages, just_blast_html]:
+		actual = app._scrub_html(html, HOST)
+		assert actual == expected, f"{app.__name__}: {actual!r} != {expected!r}"
+
+def test_double_quoted():
+	check(b'<a href="/o/1">x</a>',
+		  b'<a href="https://salsa4.salsalabs.com/o/1">x</a>')
+
+def test_single_quoted():
+	check(b"<img src='/o/2'>",
+		  b'<img src="https://salsa4.salsalabs.com/o/2">')
+
+def test_unquoted():
+	check(b'<a href=/o/1>x</a>',
+		  b'<a href="https://salsa4.salsalabs.com/o/1">x</a>')
+
+def test_apostrophe_in_unquoted_value():
+	check(b"<a title=Don't href=/o/1>link</a><img src='/o/2'>",
+		  b'<a title=Don\'t href="https://salsa4.salsalabs.com/o/1">link</a>'
+		  b'<img src="https://salsa4.salsalabs.com/o/2">')
+
+def test_apostrophe_in_unquoted_url():
+	check(b"<a href=/o/it's>x</a>",
+		  b'<a href="https://salsa4.salsalabs.com/o/it&#x27;s">x</a>')
+
+def test_bracket_in_quoted_value():
+	check(b'<a title="1>2" href="/o/late">x</a>',
+		  b'<a title="1>2" href="https://salsa4.salsalabs.com/o/late">x</a>')
+
+def test_attribute_text_in_quoted_value():
+	check(b'<a title="x src=\'/o/q\'" href="/dia/y">x</a>',
+		  b'<a title="x src=\'/o/q\'" href="https://salsa4.salsalabs.com/dia/y">x</a>')
+
+def test_old_domain():
+	check(b'<img src="http://org2.democracyinaction.org/i.png">',
+		  b'<img src="http://org2.salsalabs.com/i.png">')
+
+def test_script_body_untouched():
+	check(b'<script src="/salsa/a.js">var s = \'<img src="/o/z">\';</script>',
+		  b'<script src="https://salsa4.salsalabs.com/salsa/a.js">var s = \'<img src="/o/z">\';</script>')
+
+def test_comment_untouched():
+	html = b'<!-- <a href="/o/c">old</a> --><p>true #fff</p>'
+	check(html, html)
+
+def test_other_attributes_untouched():
+	html = b'<img data-src="true" alt="#1"><link rel=x href="https://ok.com/a.css">'
+	check(html, html)